@@ -1,17 +1,30 @@
 import streamlit as st
 import asyncio
-import base64
+import os
+import tempfile
+import hashlib
 import json
+import queue
 import time
+import threading
+from concurrent.futures import Future
 from datetime import datetime
 from io import BytesIO
 from PIL import Image
-import pandas as pd
-import plotly.graph_objects as go
-import plotly.express as px
-from typing import List, Dict, Any
+import cv2
+import numpy as np
+import pybase64
+import orjson
+from pathlib import Path
+from typing import List, Dict, Any, Tuple, Final, Optional
 
-from azure_openai_service import AzureOpenAIService
+from azure_openai_service import AzureOpenAIService, PROMPT_VERSION
+
+try:
+    import uvloop
+except ImportError:
+    # uvloop is not available on Windows; fall back to the default asyncio loop
+    uvloop = None
 
 # Page config
 st.set_page_config(
@@ -31,6 +44,157 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
+# Formats the Vision API accepts as-is, so uploads can skip a decode/re-encode
+SUPPORTED_IMAGE_TYPES = {'image/jpeg', 'image/png', 'image/webp'}
+
+# The Vision API downsamples anything larger than this on the long side
+MAX_IMAGE_DIMENSION = 2048
+
+# Quality used when an upload has to be re-encoded
+JPEG_QUALITY = 85
+
+# Analysis results for previously seen image sets, keyed by content digest
+ANALYSIS_CACHE_DIR = Path(os.getenv('ANALYSIS_CACHE_DIR') or Path(__file__).parent / ".analysis_cache")
+ANALYSIS_CACHE_TTL = 24 * 60 * 60
+
+# Display colour and indicator for each risk level
+_RISK_COLOR: Final[Dict[str, str]] = {'LOW': '#27ae60', 'MEDIUM': '#f39c12', 'HIGH': '#e74c3c'}
+_RISK_EMOJI: Final[Dict[str, str]] = {'LOW': '🟢', 'MEDIUM': '🟡', 'HIGH': '🔴'}
+
+# Longest side and quality of the gallery previews sent to the browser
+THUMBNAIL_SIZE = 320
+THUMBNAIL_QUALITY = 80
+
+@st.cache_data(show_spinner=False)
+def _make_thumbnail(raw: bytes) -> bytes:
+    """Downscale an upload to a small JPEG for the preview gallery"""
+    thumb = Image.open(BytesIO(raw))
+    thumb.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+    
+    # JPEG has no alpha channel, so flatten transparent images onto white
+    if thumb.mode in ('RGBA', 'LA') or (thumb.mode == 'P' and 'transparency' in thumb.info):
+        rgba = thumb.convert('RGBA')
+        thumb = Image.new('RGB', rgba.size, (255, 255, 255))
+        thumb.paste(rgba, mask=rgba.getchannel('A'))
+    
+    buffer = BytesIO()
+    thumb.convert('RGB').save(buffer, format='JPEG', quality=THUMBNAIL_QUALITY)
+    return buffer.getvalue()
+
+def _encode_one(upload: Tuple[str, str, bytes]) -> Dict[str, Any]:
+    """Convert an uploaded image to the base64 payload expected by the service"""
+    name, mime_type, raw = upload
+    mime_type = mime_type or 'image/jpeg'
+    data = memoryview(raw)
+    
+    # Opening only parses the header, so the size check doesn't decode pixels
+    image = Image.open(BytesIO(raw))
+    
+    # Re-encode only when the image is oversized or its format isn't accepted by the API
+    if max(image.size) > MAX_IMAGE_DIMENSION or mime_type not in SUPPORTED_IMAGE_TYPES:
+        # Decode straight into a numpy array, avoiding PIL's chunked tobytes() copy
+        pixels = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if pixels is None:
+            raise ValueError(f"Failed to decode image {name}")
+        
+        scale = MAX_IMAGE_DIMENSION / max(pixels.shape[:2])
+        if scale < 1:
+            pixels = cv2.resize(pixels, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        
+        ok, encoded = cv2.imencode('.jpg', pixels, [int(cv2.IMWRITE_JPEG_QUALITY), JPEG_QUALITY])
+        if not ok:
+            raise ValueError(f"Failed to encode image {name}")
+        data = encoded.data
+        mime_type = 'image/jpeg'
+    
+    return {
+        'base64': pybase64.b64encode_as_string(data),
+        'type': mime_type,
+        'name': name,
+        'size': data.nbytes
+    }
+
+async def _encode_all(uploads: List[Tuple[str, str, bytes]]) -> List[Dict[str, Any]]:
+    """Encode all uploaded images concurrently on worker threads"""
+    return list(await asyncio.gather(
+        *(asyncio.to_thread(_encode_one, upload) for upload in uploads)
+    ))
+
+@st.cache_resource
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """Start one long-lived event loop on a daemon thread, shared across reruns"""
+    loop = uvloop.new_event_loop() if uvloop else asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="asyncio-loop", daemon=True).start()
+    return loop
+
+def submit(coro) -> Future:
+    """Schedule a coroutine on the background event loop"""
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop())
+
+@st.cache_resource
+def get_ai_service() -> AzureOpenAIService:
+    """Create the Azure OpenAI service once per process and share it across reruns"""
+    return AzureOpenAIService()
+
+def _unique_uploads(uploads: List[Tuple[str, str, bytes]]) -> Dict[bytes, Tuple[str, str, bytes]]:
+    """Collapse uploads with identical contents, keyed by a digest of their bytes"""
+    unique = {}
+    for upload in uploads:
+        unique.setdefault(hashlib.blake2b(upload[2], digest_size=16).digest(), upload)
+    return unique
+
+def _analysis_cache_key(file_digests, deployment: str) -> str:
+    """Key a batch on its per-file digests (in any order), the model deployment and the prompt version"""
+    key = hashlib.blake2b(b''.join(sorted(file_digests)))
+    key.update(f"{deployment}:{PROMPT_VERSION}".encode())
+    return key.hexdigest()
+
+def _progress_label(field: str) -> str:
+    """Turn a streamed field path like 'detailed_assessment.fire_safety.risk_level' into a label"""
+    parts = field.split('.')
+    if len(parts) == 3:
+        return f"{parts[1].replace('_', ' ').title()} Risk Level"
+    return field.replace('_', ' ').title()
+
+def _load_cached_analysis(key: str) -> Optional[Dict[str, Any]]:
+    """Return a previously stored analysis result, if there is one that hasn't expired"""
+    path = ANALYSIS_CACHE_DIR / f"{key}.json"
+    try:
+        if time.time() - path.stat().st_mtime > ANALYSIS_CACHE_TTL:
+            path.unlink(missing_ok=True)
+            return None
+        return orjson.loads(path.read_bytes())
+    except (OSError, orjson.JSONDecodeError):
+        return None
+
+def _store_cached_analysis(key: str, result: Dict[str, Any]):
+    """Persist an analysis result so identical uploads skip the API after restarts"""
+    # Fallback results mean the response couldn't be parsed; leave them retryable
+    if 'raw_response' in result:
+        return
+    
+    # The cache is optional; a failed write must never lose a finished analysis
+    try:
+        ANALYSIS_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        _prune_cached_analyses()
+        
+        # Write to a temp file and rename it so readers never see a partial entry
+        with tempfile.NamedTemporaryFile(dir=ANALYSIS_CACHE_DIR, suffix='.tmp', delete=False) as tmp:
+            tmp.write(orjson.dumps(result))
+        os.replace(tmp.name, ANALYSIS_CACHE_DIR / f"{key}.json")
+    except (OSError, orjson.JSONEncodeError) as error:
+        print(f'Failed to cache analysis result: {error}')
+
+def _prune_cached_analyses():
+    """Delete cache entries (and leftover temp files) older than the TTL"""
+    cutoff = time.time() - ANALYSIS_CACHE_TTL
+    for path in ANALYSIS_CACHE_DIR.iterdir():
+        try:
+            if path.stat().st_mtime < cutoff:
+                path.unlink()
+        except OSError:
+            continue
+
 class BuildingRiskAnalyzer:
     def __init__(self):
         self.ai_service = None
@@ -39,7 +203,7 @@ class BuildingRiskAnalyzer:
     def _initialize_service(self):
         """Initialize Azure OpenAI service with error handling"""
         try:
-            self.ai_service = AzureOpenAIService()
+            self.ai_service = get_ai_service()
             st.success("✅ Azure OpenAI service initialized successfully")
         except Exception as e:
             st.error(f"❌ Failed to initialize Azure OpenAI service: {str(e)}")
@@ -112,9 +276,7 @@ class BuildingRiskAnalyzer:
         """Check and display service health status"""
         with st.spinner("Checking service health..."):
             try:
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-                is_healthy = loop.run_until_complete(self.ai_service.health_check())
+                is_healthy = submit(self.ai_service.health_check()).result()
                 
                 if is_healthy:
                     st.success("✅ All services healthy")
@@ -129,45 +291,36 @@ class BuildingRiskAnalyzer:
             st.error("Please upload a maximum of 10 images")
             return
             
+        # Read each upload once; both the gallery and the analysis reuse these bytes
+        uploads = [(file.name, file.type, file.getvalue()) for file in uploaded_files]
+        
         # Display uploaded images
         st.subheader("📸 Uploaded Images")
         cols = st.columns(min(len(uploaded_files), 4))
         
-        for idx, file in enumerate(uploaded_files):
+        for idx, (name, _, raw) in enumerate(uploads):
             with cols[idx % 4]:
-                image = Image.open(file)
-                st.image(image, caption=file.name, use_container_width=True)
+                st.image(_make_thumbnail(raw), caption=name, use_container_width=True)
         
         # Analysis button
         if st.button("🔍 Analyze Building Risks", type="primary"):
-            self._perform_analysis(uploaded_files)
+            self._perform_analysis(uploads)
     
-    def _perform_analysis(self, uploaded_files):
+    def _perform_analysis(self, uploads: List[Tuple[str, str, bytes]]):
         """Perform risk analysis on uploaded images"""
         with st.spinner("Analyzing building images for risk assessment..."):
             try:
-                # Prepare image data
-                image_data = []
-                for file in uploaded_files:
-                    # Convert to base64
-                    image = Image.open(file)
-                    buffer = BytesIO()
-                    image.save(buffer, format='PNG')
-                    img_base64 = base64.b64encode(buffer.getvalue()).decode()
-                    
-                    image_data.append({
-                        'base64': img_base64,
-                        'type': 'image/png',
-                        'name': file.name,
-                        'size': len(buffer.getvalue())
-                    })
+                # Only send each distinct image once
+                unique_uploads = _unique_uploads(uploads)
+                if len(unique_uploads) < len(uploads):
+                    st.info(f"Skipping {len(uploads) - len(unique_uploads)} duplicate image(s)")
                 
-                # Perform analysis
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-                analysis_result = loop.run_until_complete(
-                    self.ai_service.analyze_building_risks(image_data)
-                )
+                # Perform analysis, reusing earlier results for identical images
+                cache_key = _analysis_cache_key(unique_uploads.keys(), self.ai_service.deployment)
+                analysis_result = _load_cached_analysis(cache_key)
+                if analysis_result is None:
+                    analysis_result = self._run_analysis(list(unique_uploads.values()))
+                    _store_cached_analysis(cache_key, analysis_result)
                 
                 # Store results in session state
                 st.session_state.analysis_result = analysis_result
@@ -179,6 +332,30 @@ class BuildingRiskAnalyzer:
             except Exception as e:
                 st.error(f"❌ Analysis failed: {str(e)}")
     
+    def _run_analysis(self, uploads: List[Tuple[str, str, bytes]]) -> Dict[str, Any]:
+        """Encode uploads and stream the assessment, showing risk levels as they arrive"""
+        # Prepare image data, encoding each image on a worker thread
+        image_data = submit(_encode_all(uploads)).result()
+        
+        progress_events = queue.Queue()
+        future = submit(self.ai_service.analyze_building_risks(
+            image_data,
+            on_progress=lambda field, value: progress_events.put((field, value))
+        ))
+        
+        progress = st.empty()
+        received = {}
+        while not future.done():
+            try:
+                field, value = progress_events.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            received[field] = value
+            progress.markdown('\n'.join(f"- **{_progress_label(f)}:** {v}" for f, v in received.items()))
+        progress.empty()
+        
+        return future.result()
+    
     def _display_analysis_results(self, results: Dict[str, Any]):
         """Display comprehensive analysis results"""
         st.markdown("---")
@@ -190,11 +367,7 @@ class BuildingRiskAnalyzer:
         with col1:
             risk_level = results.get('overall_risk_level', 'UNKNOWN')
             # Add color indicator using emoji
-            risk_emoji = {
-                'LOW': '🟢',
-                'MEDIUM': '🟡', 
-                'HIGH': '🔴'
-            }.get(risk_level, '⚪')
+            risk_emoji = _RISK_EMOJI.get(risk_level, '⚪')
             st.metric("Overall Risk Level", f"{risk_emoji} {risk_level}")
         
         with col2:
@@ -214,8 +387,7 @@ class BuildingRiskAnalyzer:
         # Key findings
         if 'key_findings' in results and results['key_findings']:
             st.subheader("🔍 Key Findings")
-            for finding in results['key_findings']:
-                st.markdown(f"• {finding}")
+            st.markdown('\n'.join(f"- {finding}" for finding in results['key_findings']))
         
         # Detailed risk assessment
         self._display_detailed_assessment(results.get('detailed_assessment', {}))
@@ -223,14 +395,12 @@ class BuildingRiskAnalyzer:
         # Recommendations
         if 'recommendations' in results and results['recommendations']:
             st.subheader("💡 Recommendations")
-            for rec in results['recommendations']:
-                st.markdown(f"• {rec}")
+            st.markdown('\n'.join(f"- {rec}" for rec in results['recommendations']))
         
         # Additional information needed
         if 'additional_information_needed' in results and results['additional_information_needed']:
             st.subheader("📋 Additional Information Needed")
-            for info in results['additional_information_needed']:
-                st.markdown(f"• {info}")
+            st.markdown('\n'.join(f"- {info}" for info in results['additional_information_needed']))
         
         # Analysis summary
         if 'image_analysis_summary' in results:
@@ -244,6 +414,8 @@ class BuildingRiskAnalyzer:
     
     def _display_risk_gauge(self, risk_score: int):
         """Display risk score as a gauge chart"""
+        import plotly.graph_objects as go
+        
         fig = go.Figure(go.Indicator(
             mode="gauge+number+delta",
             value=risk_score,
@@ -271,6 +443,8 @@ class BuildingRiskAnalyzer:
     
     def _display_detailed_assessment(self, detailed_assessment: Dict[str, Any]):
         """Display detailed risk assessment by category"""
+        import plotly.graph_objects as go
+        
         if not detailed_assessment:
             return
             
@@ -287,23 +461,18 @@ class BuildingRiskAnalyzer:
                 risk_level = data['risk_level']
                 risk_levels.append(risk_level)
                 
-                color = {
-                    'LOW': '#27ae60',
-                    'MEDIUM': '#f39c12',
-                    'HIGH': '#e74c3c'
-                }.get(risk_level, '#95a5a6')
-                colors.append(color)
+                colors.append(_RISK_COLOR.get(risk_level, '#95a5a6'))
         
         if categories:
-            fig = px.bar(
+            fig = go.Figure(go.Bar(
                 x=categories,
                 y=[1] * len(categories),
-                color=risk_levels,
-                color_discrete_map={'LOW': '#27ae60', 'MEDIUM': '#f39c12', 'HIGH': '#e74c3c'},
-                title="Risk Levels by Category"
-            )
+                marker_color=colors,
+                text=risk_levels,
+                showlegend=False
+            ))
             fig.update_layout(
-                showlegend=True, 
+                title="Risk Levels by Category",
                 yaxis_title="", 
                 xaxis_title="",
                 yaxis=dict(showticklabels=False)
@@ -321,11 +490,7 @@ class BuildingRiskAnalyzer:
             # Use expander for each category
             with st.expander(f"🎯 {category_name} - Risk Level: {risk_level}", expanded=True):
                 # Risk level indicator
-                risk_emoji = {
-                    'LOW': '🟢',
-                    'MEDIUM': '🟡',
-                    'HIGH': '🔴'
-                }.get(risk_level, '⚪')
+                risk_emoji = _RISK_EMOJI.get(risk_level, '⚪')
                 
                 st.markdown(f"**Risk Level:** {risk_emoji} {risk_level}")
                 
@@ -335,14 +500,12 @@ class BuildingRiskAnalyzer:
                 with col1:
                     if 'observations' in data and data['observations']:
                         st.markdown("**📋 Observations:**")
-                        for obs in data['observations']:
-                            st.markdown(f"• {obs}")
+                        st.markdown('\n'.join(f"- {obs}" for obs in data['observations']))
                 
                 with col2:
                     if 'concerns' in data and data['concerns']:
                         st.markdown("**⚠️ Concerns:**")
-                        for concern in data['concerns']:
-                            st.markdown(f"• {concern}")
+                        st.markdown('\n'.join(f"- {concern}" for concern in data['concerns']))
 
 def main():
     """Main application entry point"""
@@ -1,105 +1,40 @@
 import os
 import base64
 import json
-from typing import List, Dict, Any, Optional
-from openai import AzureOpenAI
+import asyncio
+import orjson
+import ijson
+import httpx
+from typing import List, Dict, Any, Optional, Callable
+from openai import AsyncAzureOpenAI, DefaultAsyncHttpxClient
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
-class AzureOpenAIService:
-    """Azure OpenAI service for building risk analysis"""
-    
-    def __init__(self):
-        # Initialize Azure OpenAI client with configuration from .env
-        self.endpoint = os.getenv('4.1_OPENAI_ENDPOINT')
-        self.api_key = os.getenv('4.1_OPENAI_API_KEY')
-        self.deployment = os.getenv('4.1_OPENAI_DEPLOYMENT_NAME')
-        self.api_version = "2024-04-01-preview"
-        
-        if not all([self.endpoint, self.api_key, self.deployment]):
-            raise ValueError('Missing Azure OpenAI configuration. Please check your .env file.')
-        
-        self.client = AzureOpenAI(
-            azure_endpoint=self.endpoint,
-            api_key=self.api_key,
-            api_version=self.api_version
-        )
-        
-        print(f"Azure OpenAI Service initialized with endpoint: {self.endpoint}")
-    
-    async def analyze_building_risks(self, image_data: List[Dict[str, Any]]) -> Dict[str, Any]:
-        """
-        Analyzes building images for insurance risk assessment
-        
-        Args:
-            image_data: List of image objects with {base64, type, name, size?}
-            
-        Returns:
-            Risk assessment results as dictionary
-        """
-        try:
-            # Normalize input to array format
-            images = image_data if isinstance(image_data, list) else [image_data]
-            image_count = len(images)
-            
-            print(f"🔍 Analyzing {image_count} image(s) for building risk assessment")
-            
-            system_prompt = self._get_system_prompt(image_count)
-            user_prompt = self._get_user_prompt(image_count)
-            
-            # Prepare the user message content with text and images
-            user_content = [{"type": "text", "text": user_prompt}]
-            
-            # Add all images to the content
-            for img in images:
-                user_content.append({
-                    "type": "image_url",
-                    "image_url": {
-                        "url": f"data:{img['type']};base64,{img['base64']}",
-                        "detail": "high"
-                    }
-                })
-            
-            response = self.client.chat.completions.create(
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_content}
-                ],
-                max_tokens=3000 if image_count > 1 else 2000,
-                temperature=0.3,
-                model=self.deployment
-            )
-            
-            if hasattr(response, 'error') and response.error:
-                raise Exception(f"Azure OpenAI API Error: {response.error}")
-            
-            content = response.choices[0].message.content
-            if not content:
-                raise Exception('No response content received from Azure OpenAI')
-            
-            # Try to parse JSON response
-            try:
-                json_match = content[content.find('{'):content.rfind('}')+1]
-                if json_match:
-                    return json.loads(json_match)
-                else:
-                    return self._create_fallback_response(content, image_count)
-            except json.JSONDecodeError as parse_error:
-                print(f'Failed to parse JSON response: {parse_error}')
-                return self._create_fallback_response(content, image_count)
-                
-        except Exception as error:
-            print(f'Error analyzing building risks: {error}')
-            raise Exception(f"Risk analysis failed: {str(error)}")
-    
-    def _get_system_prompt(self, image_count: int) -> str:
-        """Generate system prompt based on number of images"""
-        return f"""You are an expert insurance underwriter specializing in building risk assessment. 
-You are analyzing {image_count} image{'s' if image_count > 1 else ''} of the same building from different angles/perspectives to provide a comprehensive risk assessment.
+OBSERVATION_SYSTEM_PROMPT = """You are an expert insurance underwriter specializing in building risk assessment.
+You are reviewing one image out of a set showing the same building. Your observations will be merged with those from the other images into a single risk assessment.
 
-{'Consider all images together to form a complete picture of the building and its risks. Look for consistent patterns across images and note any contradictions or additional context provided by multiple viewpoints.' if image_count > 1 else 'Analyze the provided building image and identify potential risks.'}
+Report only what is clearly visible or reasonably inferred from this image, grouped by risk category:
+- fire_safety: emergency exits, egress paths, fire suppression, fire-resistant materials, smoke detection
+- structural: building age and condition, construction materials, roof, foundation, seismic vulnerabilities
+- security: access control, lighting, perimeter, surveillance
+- water_damage: proximity to water, drainage, below-grade areas, plumbing
+- occupancy: occupancy load, hazardous activities or storage, mixed use, accessibility
+- environmental: surrounding hazards, natural disaster exposure, utility infrastructure
+
+Respond in the following JSON format, omitting categories with nothing to report:
+{
+  "fire_safety": {"observations": ["observation1"], "concerns": ["concern1"]},
+  "structural": {"observations": ["observation1"], "concerns": ["concern1"]}
+}"""
+
+def _build_system_prompt(multiple: bool) -> str:
+    """Build the system prompt template, leaving {image_count} as a placeholder"""
+    return f"""You are an expert insurance underwriter specializing in building risk assessment. 
+You are analyzing {{image_count}} image{'s' if multiple else ''} of the same building from different angles/perspectives to provide a comprehensive risk assessment.
+
+{'Consider all images together to form a complete picture of the building and its risks. Look for consistent patterns across images and note any contradictions or additional context provided by multiple viewpoints.' if multiple else 'Analyze the provided building image and identify potential risks.'}
 
 Focus on these key risk categories:
 
@@ -144,7 +79,7 @@ Provide your analysis in the following JSON format:
 {{
   "overall_risk_level": "LOW|MEDIUM|HIGH",
   "risk_score": 1-10,
-  "images_analyzed": {image_count},
+  "images_analyzed": {{image_count}},
   "key_findings": ["finding1", "finding2", "finding3"],
   "detailed_assessment": {{
     "fire_safety": {{
@@ -175,10 +110,225 @@ Provide your analysis in the following JSON format:
   }},
   "recommendations": ["recommendation1", "recommendation2", "recommendation3"],
   "additional_information_needed": ["info1", "info2"],
-  "image_analysis_summary": "{'Summary of what was observed across all images and how they complement each other' if image_count > 1 else 'Summary of the single image analysis'}"
+  "image_analysis_summary": "{'Summary of what was observed across all images and how they complement each other' if multiple else 'Summary of the single image analysis'}"
 }}
 
-Be thorough but realistic in your assessment. Only identify risks that are clearly visible or reasonably inferred from the images. {'When analyzing multiple images, provide insights that benefit from having multiple perspectives of the same building.' if image_count > 1 else ''}"""
+Be thorough but realistic in your assessment. Only identify risks that are clearly visible or reasonably inferred from the images. {'When analyzing multiple images, provide insights that benefit from having multiple perspectives of the same building.' if multiple else ''}"""
+
+_SYS_PROMPT_SINGLE = _build_system_prompt(multiple=False)
+_SYS_PROMPT_MULTI = _build_system_prompt(multiple=True)
+
+_JSON_DECODER = json.JSONDecoder()
+
+# Bump whenever a prompt changes so cached analyses from older prompts are not reused
+PROMPT_VERSION = 1
+
+# Top-level fields reported while a response is streaming, alongside per-category risk levels
+PROGRESS_FIELDS = {'overall_risk_level', 'risk_score'}
+
+class AzureOpenAIService:
+    """Azure OpenAI service for building risk analysis"""
+    
+    def __init__(self):
+        # Initialize Azure OpenAI client with configuration from .env
+        self.endpoint = os.getenv('4.1_OPENAI_ENDPOINT')
+        self.api_key = os.getenv('4.1_OPENAI_API_KEY')
+        self.deployment = os.getenv('4.1_OPENAI_DEPLOYMENT_NAME')
+        self.api_version = "2024-04-01-preview"
+        
+        if not all([self.endpoint, self.api_key, self.deployment]):
+            raise ValueError('Missing Azure OpenAI configuration. Please check your .env file.')
+        
+        # HTTP/2 multiplexes concurrent per-image requests over one pooled connection
+        self.http_client = DefaultAsyncHttpxClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=20),
+            timeout=60.0
+        )
+        
+        self.client = AsyncAzureOpenAI(
+            azure_endpoint=self.endpoint,
+            api_key=self.api_key,
+            api_version=self.api_version,
+            http_client=self.http_client
+        )
+        
+        print(f"Azure OpenAI Service initialized with endpoint: {self.endpoint}")
+    
+    async def analyze_building_risks(
+        self,
+        image_data: List[Dict[str, Any]],
+        on_progress: Optional[Callable[[str, Any], None]] = None
+    ) -> Dict[str, Any]:
+        """
+        Analyzes building images for insurance risk assessment
+        
+        Args:
+            image_data: List of image objects with {base64, type, name, size?}
+            on_progress: Optional callback receiving (field, value) for risk levels
+                and score as soon as they arrive in the streamed response
+            
+        Returns:
+            Risk assessment results as dictionary
+        """
+        try:
+            # Normalize input to array format
+            images = image_data if isinstance(image_data, list) else [image_data]
+            image_count = len(images)
+            
+            print(f"🔍 Analyzing {image_count} image(s) for building risk assessment")
+            
+            system_prompt = self._get_system_prompt(image_count)
+            
+            if image_count > 1:
+                # Extract observations from each image concurrently, then merge them in one call
+                observations = await asyncio.gather(*(
+                    self._observe_image(img, idx + 1, image_count) for idx, img in enumerate(images)
+                ))
+                user_content = self._get_aggregation_prompt(observations)
+            else:
+                user_content = [
+                    {"type": "text", "text": self._get_user_prompt(image_count)},
+                    self._image_content(images[0])
+                ]
+            
+            max_tokens = 3000 if image_count > 1 else 2000
+            if on_progress:
+                content = await self._stream_complete(system_prompt, user_content, max_tokens, on_progress)
+            else:
+                content = await self._complete(system_prompt, user_content, max_tokens)
+            
+            return self._parse_response(content, image_count)
+            
+        except Exception as error:
+            print(f'Error analyzing building risks: {error}')
+            raise Exception(f"Risk analysis failed: {str(error)}")
+    
+    def _parse_response(self, content: str, image_count: int) -> Dict[str, Any]:
+        """Parse the JSON assessment from the response, falling back if none is found"""
+        # Fast path: the model usually returns bare JSON
+        try:
+            result = orjson.loads(content)
+            if isinstance(result, dict):
+                return result
+        except orjson.JSONDecodeError:
+            pass
+        
+        # Otherwise decode the first JSON object embedded in surrounding text
+        start = content.find('{')
+        if start == -1:
+            return self._create_fallback_response(content, image_count)
+        
+        try:
+            result, _ = _JSON_DECODER.raw_decode(content, start)
+            return result
+        except json.JSONDecodeError as parse_error:
+            print(f'Failed to parse JSON response: {parse_error}')
+            return self._create_fallback_response(content, image_count)
+    
+    async def _observe_image(self, img: Dict[str, Any], index: int, image_count: int) -> str:
+        """Extract risk-relevant observations from a single image"""
+        user_content = [
+            {"type": "text", "text": self._get_observation_prompt(index, image_count)},
+            self._image_content(img)
+        ]
+        return await self._complete(OBSERVATION_SYSTEM_PROMPT, user_content, max_tokens=1000)
+    
+    def _chat_request(self, system_prompt: str, user_content: Any, max_tokens: int) -> Dict[str, Any]:
+        """Build the chat completion arguments shared by streamed and non-streamed calls"""
+        return {
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_content}
+            ],
+            "max_tokens": max_tokens,
+            "temperature": 0.3,
+            "model": self.deployment
+        }
+    
+    async def _complete(self, system_prompt: str, user_content: Any, max_tokens: int) -> str:
+        """Send a chat completion request and return the response text"""
+        response = await self.client.chat.completions.create(
+            **self._chat_request(system_prompt, user_content, max_tokens)
+        )
+        
+        if hasattr(response, 'error') and response.error:
+            raise Exception(f"Azure OpenAI API Error: {response.error}")
+        
+        content = response.choices[0].message.content
+        if not content:
+            raise Exception('No response content received from Azure OpenAI')
+        
+        return content
+    
+    async def _stream_complete(
+        self,
+        system_prompt: str,
+        user_content: Any,
+        max_tokens: int,
+        on_progress: Callable[[str, Any], None]
+    ) -> str:
+        """Stream a chat completion, reporting assessment fields as they are parsed"""
+        stream = await self.client.chat.completions.create(
+            **self._chat_request(system_prompt, user_content, max_tokens),
+            stream=True
+        )
+        
+        parts = []
+        events = ijson.sendable_list()
+        parser = ijson.parse_coro(events)
+        json_started = False
+        
+        async for chunk in stream:
+            # Azure sends content filter results in chunks without choices
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            
+            delta = chunk.choices[0].delta.content
+            parts.append(delta)
+            if parser is None:
+                continue
+            
+            # Skip any text the model writes before the JSON object
+            if not json_started:
+                start = delta.find('{')
+                if start == -1:
+                    continue
+                delta = delta[start:]
+                json_started = True
+            
+            try:
+                parser.send(delta.encode())
+            except ijson.JSONError:
+                # Progress is best-effort; the full response is parsed once complete.
+                # Events parsed before the error (e.g. ahead of a trailing ```) are still reported.
+                parser = None
+            
+            for prefix, event, value in events:
+                if event in ('string', 'number') and (prefix in PROGRESS_FIELDS or prefix.endswith('.risk_level')):
+                    on_progress(prefix, value)
+            del events[:]
+        
+        content = ''.join(parts)
+        if not content:
+            raise Exception('No response content received from Azure OpenAI')
+        
+        return content
+    
+    def _image_content(self, img: Dict[str, Any]) -> Dict[str, Any]:
+        """Build the image_url message part for an image object"""
+        return {
+            "type": "image_url",
+            "image_url": {
+                "url": f"data:{img['type']};base64,{img['base64']}",
+                "detail": "high"
+            }
+        }
+    
+    def _get_system_prompt(self, image_count: int) -> str:
+        """Generate system prompt based on number of images"""
+        template = _SYS_PROMPT_MULTI if image_count > 1 else _SYS_PROMPT_SINGLE
+        return template.replace('{image_count}', str(image_count))
     
     def _get_user_prompt(self, image_count: int) -> str:
         """Generate user prompt based on number of images"""
@@ -187,6 +337,17 @@ Be thorough but realistic in your assessment. Only identify risks that are clear
         else:
             return "Please analyze this building image for insurance underwriting risk assessment. Provide a comprehensive evaluation of all visible risk factors."
     
+    def _get_observation_prompt(self, index: int, image_count: int) -> str:
+        """Generate user prompt for extracting observations from one image"""
+        return f"This is image {index} of {image_count} of the same building. List the risk-relevant observations visible in this image."
+    
+    def _get_aggregation_prompt(self, observations: List[str]) -> str:
+        """Generate user prompt that merges per-image observations into one assessment"""
+        sections = "\n\n".join(
+            f"Image {idx}:\n{obs}" for idx, obs in enumerate(observations, start=1)
+        )
+        return f"{self._get_user_prompt(len(observations))}\n\nThe images were reviewed individually; these are the observations extracted from each image:\n\n{sections}"
+    
     def _create_fallback_response(self, content: str, image_count: int) -> Dict[str, Any]:
         """Create fallback response when JSON parsing fails"""
         return {
@@ -215,7 +376,7 @@ Be thorough but realistic in your assessment. Only identify risks that are clear
             Connection status as boolean
         """
         try:
-            response = self.client.chat.completions.create(
+            response = await self.client.chat.completions.create(
                 messages=[
                     {"role": "system", "content": "You are a helpful assistant."},
                     {"role": "user", "content": "Hello, please respond with 'OK' to confirm connectivity."}